@@ -0,0 +1,24 @@
+"""
+Optional numba support for numeric kernels.
+
+Kernels decorated with maybe_njit are compiled by numba on their first call
+and cached on disk, so that restarting a jupyter kernel reuses the compiled
+code. When numba is not installed they are left as plain python functions:
+callers should check HAS_NUMBA and use numpy code instead of python loops.
+"""
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAS_NUMBA = numba is not None
+
+prange = numba.prange if HAS_NUMBA else range
+
+
+def maybe_njit(**kwargs):
+    if not HAS_NUMBA:
+        return lambda func: func
+
+    kwargs.setdefault("cache", True)
+    return numba.njit(**kwargs)
@@ -0,0 +1,56 @@
+"""
+Ahead of time compilation of the numeric kernels of
+dd_widgets.timeseries.kernels.
+
+    python dd_widgets/_kernels_build.py
+
+builds the dd_widgets.dd_kernels extension next to this file. setup.py
+also builds it when DD_WIDGETS_BUILD_KERNELS=1 is set and numba is
+installed (use pip --no-build-isolation). When it is present, the
+kernels use it until their numba JIT versions are compiled, and instead of
+numpy code when numba is not installed.
+
+numba does not compile parallel code ahead of time, so the exported
+kernels are the sequential versions of the JIT kernels.
+
+Only kernels.py and _jit.py are loaded: dd_widgets/__init__.py needs a
+notebook environment, which is not available at build time.
+"""
+import importlib
+import os
+import sys
+import types
+
+from numba.pycc import CC
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def load_kernels():
+    for name, path in [("dd_widgets", PACKAGE_DIR),
+                       ("dd_widgets.timeseries", os.path.join(PACKAGE_DIR, "timeseries"))]:
+        if name not in sys.modules:
+            # empty package, its __init__.py is not run
+            package = types.ModuleType(name)
+            package.__path__ = [path]
+            sys.modules[name] = package
+
+    return importlib.import_module("dd_widgets.timeseries.kernels")
+
+kernels = load_kernels()
+
+cc = CC("dd_kernels")
+cc.output_dir = PACKAGE_DIR
+
+for t in kernels.AOT_TYPES.values():
+    cc.export("minmax_norm_" + t, "void({0}[:,:], {0}[:,:], f8)".format(t))(
+        kernels._minmax_norm.py_func)
+    cc.export("minmax_norm_pair_" + t, "void({0}[:,:], {0}[:,:], {0}[:,:], {0}[:,:], f8)".format(t))(
+        kernels._minmax_norm_pair.py_func)
+    cc.export("minmax_bounds_" + t, "void({0}[:,:], {0}[:], {0}[:], f8)".format(t))(
+        kernels._minmax_bounds.py_func)
+    cc.export("mean_abs_error_norm_" + t, "f8({0}[:], {0}[:], f8)".format(t))(
+        kernels._mean_abs_error_norm.py_func)
+
+
+if __name__ == "__main__":
+    cc.compile()
@@ -1,6 +1,9 @@
 import os
 import sys
 import csv
+import glob
+import hashlib
+import threading
 import io
 import re
 import time
@@ -9,8 +12,11 @@ import pandas as pd
 import altair as alt
 import matplotlib.pyplot as plt
 import scipy.signal
+from matplotlib.collections import PatchCollection
+from matplotlib.patches import Rectangle
 import tqdm
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import List, Dict, Any
 from tqdm import notebook
@@ -23,6 +29,20 @@ from ..widgets import GPUIndex, Solver
 from ..utils import sample_from_iterable
 from ..mixins import ImageTrainerMixin
 from . import anomalies as ano
+from . import kernels
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is optional, predictions are dumped as csv without it
+    pa = None
+    pq = None
+
+# file extension of each format predictions can be dumped to
+DUMP_FORMATS = {"parquet": ".parquet", "csv": ".csv"}
+# buffer size used when writing csv dumps
+DUMP_BUFFER_SIZE = 1 << 20
 
 # Helper functions
 
@@ -33,6 +53,27 @@ def get_col(header,l):
     print(header, l)
     raise IndexError("not found")
 
+def get_col_index(header):
+    """
+    Build {label: column id} from header, so that columns can be looked up
+    without scanning the header with get_col every time
+    """
+    col_index = {}
+    for i,hl in enumerate(header):
+        # keep first match like get_col
+        col_index.setdefault(hl, i)
+    return col_index
+
+def get_cols(header, labels):
+    """
+    Column ids of labels in header, first match like get_col
+    """
+    col_index = get_col_index(header)
+    missing = [l for l in labels if l not in col_index]
+    if missing:
+        raise IndexError("columns %s not found in header %s" % (missing, header))
+    return [col_index[l] for l in labels]
+
 def get_datafiles(datadir, prefix = ""):
     """
     Scan directory for all csv files
@@ -40,46 +81,116 @@ def get_datafiles(datadir, prefix = ""):
     """
     datafiles = []
 
-    for fname in os.listdir(datadir):
-        fpath = os.path.join(datadir, fname)
-        datafile = os.path.join(prefix, fname)
+    # scandir entries cache file type, avoiding one stat per file
+    with os.scandir(datadir) as entries:
+        for entry in entries:
+            datafile = os.path.join(prefix, entry.name)
 
-        if os.path.isdir(fpath):
-            datafiles += get_datafiles(fpath, datafile)
-        elif fname.endswith(".csv"):
-            datafiles.append(datafile)
+            if entry.is_dir():
+                datafiles += get_datafiles(entry.path, datafile)
+            elif entry.name.endswith(".csv"):
+                datafiles.append(datafile)
 
     return datafiles
 
 def dump_data(data, labels, filename):
-    file = open(filename,"w")
-    datawriter=csv.writer(file, quoting=csv.QUOTE_NONNUMERIC)
-    datawriter.writerow(labels)
-    for ts in range(data.shape[0]):
-        datawriter.writerow(data[ts,:])
-    file.close()
-
-def load_target(datafile,labels):
-    csvfile = open(datafile)
-    csv_reader = csv.reader(csvfile, delimiter=',')
-    header = next(csv_reader)
-    col_labels = []
-    targets = []
-    for l in labels:
-        col_labels.append(get_col(header,l))
-
-    for data in csv_reader:
-         targets.append([float(data[i]) for i in col_labels])
-    return targets
-
-def load_data(filename):
-    file = open(filename,"r")
-    datareader = csv.reader(file,quoting=csv.QUOTE_NONNUMERIC)
-    header = next(datareader)
-    data = []
-    for tsdata in datareader:
-        data.append(tsdata)
-    return np.asarray(data)
+    """
+    Write data to filename, as parquet if filename ends with .parquet and
+    as csv otherwise
+    """
+    if filename.endswith(DUMP_FORMATS["parquet"]):
+        table = pa.Table.from_arrays([pa.array(data[:,i]) for i in range(data.shape[1])], names = list(labels))
+        pq.write_table(table, filename, compression = "zstd")
+        return
+
+    # csv is kept for compatibility with previous dumps
+    df = pd.DataFrame(data, columns = labels)
+
+    # large user-space buffer: few write syscalls even for many small files
+    with open(filename, "w", buffering = DUMP_BUFFER_SIZE, newline = "") as file:
+        df.to_csv(file, index = False, quoting = csv.QUOTE_NONNUMERIC)
+
+def load_target(datafile, labels, dtype = np.float32):
+    """
+    Load columns `labels` of datafile, in the order of `labels`
+    """
+    df = pd.read_csv(datafile, usecols = labels, dtype = dtype)
+    # column major: signals are read one at a time (see plot_predictions)
+    return np.asfortranarray(df[labels].to_numpy())
+
+def load_data(filename, dtype = np.float32):
+    if filename.endswith(DUMP_FORMATS["parquet"]):
+        data = pq.read_table(filename).to_pandas().to_numpy(dtype = dtype)
+    else:
+        data = pd.read_csv(filename, dtype = dtype).to_numpy()
+    return np.asfortranarray(data)
+
+def load_cached(path, loader, cache_prefix):
+    """
+    Load path with loader, and keep the result in a .npy file so that next
+    loads are memory mapped instead of parsed again. The cache file name is
+    cache_prefix followed by the modification time (in ns) and size of path,
+    so that a cache is only used for the version of path it was made from,
+    even on file systems with a coarse modification time.
+    returns: the loaded data, a read-only memory map when loaded from cache
+    """
+    stat = os.stat(path)
+    cache_file = "%s.%d-%d.npy" % (cache_prefix, stat.st_mtime_ns, stat.st_size)
+
+    try:
+        return np.load(cache_file, mmap_mode = "r")
+    except OSError:
+        # no cache yet
+        pass
+
+    data = loader(path)
+
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+        # write then rename, so that an interrupted save leaves no cache
+        tmp_file = cache_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp_file, cache_file)
+
+        # caches of previous versions of path
+        for old_file in glob.glob(glob.escape(cache_prefix) + ".*-*.npy"):
+            if old_file != cache_file:
+                os.remove(old_file)
+    except OSError:
+        # eg read-only cache directory, loading still works without cache
+        pass
+
+    return data
+
+def get_cache_key(*params):
+    return hashlib.md5(repr(params).encode()).hexdigest()[:12]
+
+def isin_sorted(values, sorted_ref):
+    """
+    Same as np.isin(values, sorted_ref), using binary search in sorted_ref
+    """
+    values = np.asarray(values)
+    sorted_ref = np.asarray(sorted_ref)
+    if len(sorted_ref) == 0:
+        return np.zeros(values.shape, dtype=bool)
+
+    idx = np.searchsorted(sorted_ref, values)
+    # values greater than all references are compared with the last one
+    np.minimum(idx, len(sorted_ref) - 1, out=idx)
+    return sorted_ref[idx] == values
+
+def add_vspans(ax, starts, ends, **kwargs):
+    """
+    Same as ax.axvspan(start, end, **kwargs) for every span, but draws all
+    the spans with a single matplotlib artist
+    """
+    rects = [Rectangle((a, 0), b - a, 1) for a, b in zip(starts, ends)]
+
+    if rects:
+        # x in data coordinates, y from bottom to top of the axes
+        spans = PatchCollection(rects, transform = ax.get_xaxis_transform(), edgecolor = "none", **kwargs)
+        ax.add_collection(spans, autolim = False)
 
 def concat_all_datafiles(errors, datafiles):
     """
@@ -89,38 +200,62 @@ def concat_all_datafiles(errors, datafiles):
 
     errors[datafile][model] -> concatened_error[model]
     """
-    result = {}
+    buckets = {}
 
     for datafile in datafiles:
         error = errors[datafile]
 
         for model in error:
-            if model not in result:
-                result[model] = error[model]
-            else:
-                result[model] = np.concatenate((result[model], error[model]), axis = 0)
+            buckets.setdefault(model, []).append(error[model])
 
-    return result
+    return {model: np.concatenate(buckets[model], axis = 0) for model in buckets}
 
 def normalize_error(data):
-    eps = 1E-5
-    max_data = np.amax(data,axis=0)
-    min_data = np.min(data,axis=0)
-    norm_data=np.divide((data-min_data),(max_data-min_data+eps))
-    return norm_data
+    return kernels.minmax_norm(data)
 
 def normalize_data(pred,targ):
-    eps = 1E-5
-    max_data = np.amax(targ,axis=0)
-    min_data = np.min(targ,axis=0)
-    norm_pred= np.divide((pred-min_data),(max_data-min_data+eps))
-    norm_targ= np.divide((targ-min_data),(max_data-min_data+eps))
-    return norm_pred, norm_targ
+    """
+    Normalize pred and targ using min / max of the target
+    """
+    return kernels.minmax_norm_pair(pred, targ)
 
 def get_signal_mean_error(pred, targ, feat):
-    pred_norm, targ_norm = normalize_data(pred[:,feat], targ[:,feat])
-    mean_error = np.mean(np.absolute(targ_norm - pred_norm))
-    return mean_error
+    return kernels.mean_abs_error_norm(pred[:,feat], targ[:,feat])
+
+def stack_preds(preds):
+    """
+    Stack predictions of several models in one array.
+    preds: dict {model_name: pred}, every pred must have the same shape
+    returns: list of model names, array (n_models, timesteps, n_features)
+        where values of one feature are contiguous for all models
+    """
+    model_names = list(preds)
+
+    if len(model_names) == 0:
+        return model_names, np.empty((0, 0, 0), dtype = np.float32)
+
+    shape = (len(model_names),) + preds[model_names[0]].shape
+    preds_arr = np.empty(shape, dtype = np.result_type(*preds.values()), order = "F")
+
+    for i, model_name in enumerate(model_names):
+        preds_arr[i] = preds[model_name]
+
+    return model_names, preds_arr
+
+def get_stacked_mean_error(preds_arr, targ, feat):
+    """
+    get_signal_mean_error() for all predictions of stack_preds(), in one
+    vectorized pass.
+    returns: array of mean errors, one by model
+    """
+    if len(preds_arr) == 0:
+        return np.empty(0)
+
+    targ_feat = targ[:,feat]
+
+    # |norm(t) - norm(p)| = |t - p| / (max - min + eps)
+    _, inv_range = kernels.minmax_bounds(targ_feat)
+    return np.mean(np.absolute(preds_arr[:,:,feat] - targ_feat), axis=1) * inv_range
 
 
 class PlotParameters:
@@ -150,7 +285,7 @@ class AnomalyParameters:
 
         self.method = method
         self.smooth_factor = smooth_factor
-        self.labels = []
+        self._labels = []
         self.ignore = ignore
         self.threshold = threshold
         # Total number of anomalies detected
@@ -161,6 +296,52 @@ class AnomalyParameters:
 
         self.err_norm_model = None
 
+        # {parameters: (error, results, fitted model)} of the last
+        # compute_anomalies() calls
+        self._cache = {}
+        # compute_anomalies() may be called from several threads
+        self._cache_lock = threading.Lock()
+
+    # max number of results kept by compute_anomalies()
+    cache_size = 64
+
+    @property
+    def smooth_factor(self):
+        return self._smooth_factor
+
+    @smooth_factor.setter
+    def smooth_factor(self, smooth_factor):
+        self._smooth_factor = smooth_factor
+        # smoothing kernel, computed once for all signals
+        c = smooth_factor + 1
+        self._conv = np.full(c, 1 / c)
+
+    @property
+    def labels(self):
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels):
+        self._labels = list(labels)
+        self._update_col_ids()
+
+    @property
+    def ignore(self):
+        return self._ignore
+
+    @ignore.setter
+    def ignore(self, ignore):
+        self._ignore = frozenset(ignore)
+        self._update_col_ids()
+
+    def _update_col_ids(self):
+        """
+        Precompute ids of the labels that are not ignored, so that they are
+        not searched again every time an error is processed.
+        """
+        self._label_idx = get_col_index(self._labels)
+        self._col_ids = [self._label_idx[lbl] for lbl in self._labels if lbl not in self._ignore]
+
     def available_methods():
         return ["threshold_norm", "threshold", "peaks", "votes", "gaussian"]
 
@@ -171,67 +352,135 @@ class AnomalyParameters:
         signal.
         """
         err_norm_model = ano.ErrorNormalizationModel()
-        c = self.smooth_factor + 1
-        conv = [1 / c] * c
-
-        col_ids = []
-        for lbl in self.labels:
-            if lbl not in self.ignore:
-                col_ids.append(get_col(self.labels,lbl))
 
-        error = error[:,col_ids]
-        err_norm_model.fit(error, conv, display = True)
+        error = error[:,self._col_ids]
+        error_smooth = ano.moving_average(error, self.smooth_factor + 1)
+        err_norm_model.fit(error_smooth, display = True)
 
         self.err_norm_model = err_norm_model
+        self.clear_cache()
+
+    def clear_cache(self):
+        """
+        Forget results of previous compute_anomalies() calls. Needed if an
+        error array is modified in place.
+        """
+        self._cache = {}
+
+    def _params_key(self):
+        """
+        returns: a hashable summary of the parameters anomalies depend on
+        """
+        return (self.method, self.threshold, self.smooth_factor,
+                self.n_anomalies, self.peak_width, self._ignore,
+                tuple(self._col_ids), id(self.err_norm_model))
 
     def compute_anomalies(self, error, display = False):
         """
         Compute anomalies of signal based on the prediction
-        error on the signal
+        error on the signal. Results are cached for the same error array
+        and parameters, so that refreshing the UI does not compute them
+        again.
         error: the error of signal
+        display: show details (error distributions, share of selected
+            errors), see display_details(). They are shown again when the
+            results come from the cache.
         returns: list of anomaly dates (in timesteps), signal allowing to
             compute anomalies (typically avg mean error), list of other
             potential anomaly dates
         """
-        c = self.smooth_factor + 1
-        conv = [1 / c] * c
+        results, model = self.compute_anomalies_details(error)
+
+        if display:
+            self.display_details(results, model)
+        return results
+
+    def compute_anomalies_details(self, error):
+        """
+        compute_anomalies() without display, for several errors in parallel.
+        returns: results of compute_anomalies(), error model fitted to
+            compute them (None if err_norm_model was used or the method
+            does not fit any), to be passed to display_details()
+        """
+        key = (id(error),) + self._params_key()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+
+        # the error is kept with the results, so its id cannot be reused
+        if cached is not None and cached[0] is error:
+            return cached[1], cached[2]
+
+        results, model = self._compute_anomalies(error)
+
+        with self._cache_lock:
+            if len(self._cache) >= self.cache_size:
+                # forget the oldest result
+                del self._cache[next(iter(self._cache))]
+            self._cache[key] = (error, results, model)
+        return results, model
+
+    def display_details(self, results, model = None):
+        """
+        Display details of results returned by compute_anomalies_details()
+        with the error model fitted to compute them.
+        """
+        if self.method not in ["threshold_norm", "gaussian"]:
+            return
+
+        if model is not None:
+            model.display_fit()
+
+        anomalies, ano_signal, _ = results
+        print("Selected %0.1f%% of errors" % (len(anomalies) / len(ano_signal) * 100))
+
+    def _compute_anomalies(self, error):
+        conv = self._conv
         ano_signal = None
         ano_peaks = None
+        # error model fitted for this error only
+        fitted_model = None
 
         # eliminate ignored labels
-        col_ids = []
-        for lbl in self.labels:
-            if lbl not in self.ignore:
-                col_ids.append(get_col(self.labels,lbl))
-
+        # (indexing copies error, so it can be modified in place below)
+        col_ids = self._col_ids
         error = error[:,col_ids]
-        error_norm = normalize_error(np.absolute(error))
+        window = len(conv)
 
+        if self.method in ["peaks", "votes", "threshold"]:
+            # these methods only use the normalized absolute error
+            error_norm = normalize_error(np.abs(error, out = error))
+
+        # Smoothing is linear, so the error can be smoothed before being
+        # passed to the anomaly routines instead of convolving each signal
         if self.method == "threshold_norm":
             err_norm_model = self.err_norm_model
+            error_smooth = ano.moving_average(error, window)
 
             if not err_norm_model:
-                err_norm_model = ano.ErrorNormalizationModel()
-                err_norm_model.fit(error, conv, display = display)
+                err_norm_model = fitted_model = ano.ErrorNormalizationModel()
+                err_norm_model.fit(error_smooth)
 
-            anomalies, ano_signal, ano_peaks = err_norm_model.anomaly_dates(error, self.threshold, conv, display = display)
+            anomalies, ano_signal, ano_peaks = err_norm_model.anomaly_dates(error_smooth, self.threshold)
         elif self.method == "gaussian":
             gauss_model = self.err_norm_model
+            error_smooth = ano.moving_average(error, window)
 
             if not gauss_model:
-                gauss_model = ano.ErrorNormalizationModel()
-                gauss_model.fit(error, conv, fit_gauss = True, display = display)
+                gauss_model = fitted_model = ano.ErrorNormalizationModel()
+                gauss_model.fit(error_smooth, fit_gauss = True)
 
-            anomalies, ano_signal, ano_peaks = gauss_model.anomaly_dates(error, self.threshold, conv, display = display)
+            anomalies, ano_signal, ano_peaks = gauss_model.anomaly_dates(error_smooth, self.threshold)
         elif self.method == "peaks":
             # ano_signal = error_peaks(error_norm, conv=conv)
             # anomalies = anomaly_dates(ano_signal, 20)
-            anomalies, ano_signal, ano_peaks = ano.anomaly_dates_peaks(error_norm, self.n_anomalies,conv=conv, peak_width = self.peak_width)
+            error_smooth = ano.moving_average(error_norm, window)
+            anomalies, ano_signal, ano_peaks = ano.anomaly_dates_peaks(error_smooth, self.n_anomalies, peak_width = self.peak_width)
         elif self.method == "votes":
+            # votes are not linear in the error: smooth the votes themselves
             ano_signal = ano.error_vote(error_norm, self.n_anomalies, conv=conv)
             anomalies = ano.anomaly_dates_votes(ano_signal, self.n_anomalies)
         elif self.method == "threshold":
-            error_norm = ano.sum_conv_error(error_norm, conv) / len(col_ids)
+            error_norm = ano.moving_average(error_norm.mean(axis=1), window)
             ano_signal = error_norm
             anomalies = np.where(error_norm > self.threshold)[0]
         else:
@@ -240,36 +489,25 @@ class AnomalyParameters:
                 % (self.method, str(AnomalyParameters.available_methods()))
             )
 
-        return anomalies, ano_signal, ano_peaks
+        return (anomalies, ano_signal, ano_peaks), fitted_model
 
     def get_anomaly_results(self, pred_anom, targ_anom):
         """
         Compute accuracy & recall of the model in predicting anomalies.
         pred_anom: list of anomalies as obtained by the compute_anomalies()
             method
-        targ_anom: bounds of anomalies to detect (ground truth)
+        targ_anom: bounds of anomalies to detect (ground truth), the bounds
+            should not overlap
         Return: true positive / false negative / false positive
         """
-        found = [False] * len(targ_anom)
-        fps = []
-
-        for anom in pred_anom:
-            match = False
-
-            for i in range(len(targ_anom)):
-                start, end = targ_anom[i]
-
-                if start <= anom <= end:
-                    found[i] = True
-                    match = True
-                    break
+        pred = np.asarray(pred_anom)
 
-            if not match:
-                fps.append(anom)
+        if len(targ_anom) == 0:
+            return 0, 0, len(pred)
 
-        tp = sum([1 for i in found if i])
-        fn = len(targ_anom) - tp
-        return tp, fn, len(fps)
+        ta = np.asarray(targ_anom)
+        order = np.argsort(ta[:,0], kind="stable")
+        return kernels.anomaly_results(pred, ta[order,0], ta[order,1])
 
     def get_anomaly_score(self, pred_anom, targ_anom):
         """
@@ -294,9 +532,9 @@ class LoggerParameters:
         # jp_display.clear_output(wait = True)
         self.log_progress("Done!")
 
-    def progress_bar(self, generator, leave = False):
+    def progress_bar(self, generator, leave = False, total = None):
         if self.display_progress:
-            return tqdm.notebook.tqdm(generator, leave = leave)
+            return tqdm.notebook.tqdm(generator, leave = leave, total = total)
         else:
             return generator
 
@@ -304,6 +542,10 @@ class Timeseries(ImageTrainerMixin):
     """
     Train and predict timeseries in jupyter.
     """
+    # True if predict_file() can be called on several files at the same time,
+    # i.e. predictions do not depend on a state kept between predict calls
+    concurrent_predict = False
+
     def __init__(self,
                 sname: str,
                 local_vars : Dict[str, Any] = {}):
@@ -375,10 +617,13 @@ class Timeseries(ImageTrainerMixin):
                     selection, alt.Color("variable:N"), alt.value("lightgray")
                 )
                 scales = alt.selection_interval(encodings=["x"], bind="scales")
+                # let vega-lite melt the columns instead of sending the
+                # long form of the dataframe
                 chart = (
-                    alt.Chart(df.melt().reset_index())
+                    alt.Chart(df.reset_index())
+                    .transform_fold(list(df.columns), as_=["variable", "value"])
                     .mark_line()
-                    .encode(x="index", y="value", color=color)
+                    .encode(x="index:Q", y="value:Q", color=color)
                     .add_selection(selection)
                     .transform_filter(selection)
                     .properties(width=400, height=300)
@@ -419,7 +664,12 @@ class TimeseriesPlot:
                 ignored_cols = [],
                 anomaly_params = AnomalyParameters(),
                 plot_params = PlotParameters(),
-                logger_params = LoggerParameters()):
+                logger_params = LoggerParameters(),
+                dump_format = None,
+                max_workers = None,
+                use_file_cache = True,
+                cache_dir = None,
+                dtype = np.float32):
 
         self.models = models
         self.datafiles = datafiles
@@ -436,18 +686,83 @@ class TimeseriesPlot:
         self.plot_params = plot_params
         self.logger_params = logger_params
 
+        # format of the predictions / errors written to output_dir,
+        # "parquet" (default when pyarrow is available) or "csv"
+        if dump_format is None:
+            dump_format = "parquet" if pq is not None else "csv"
+        if dump_format not in DUMP_FORMATS:
+            raise ValueError(
+                "Unknown dump format: %s. Available formats are %s"
+                % (dump_format, str(list(DUMP_FORMATS)))
+            )
+        if dump_format == "parquet" and pq is None:
+            raise RuntimeError("pyarrow is required to dump predictions as parquet")
+        self.dump_format = dump_format
+
+        # number of threads used to predict / dump datafiles in parallel
+        self.max_workers = max_workers if max_workers else os.cpu_count()
+        # keep parsed targets / predictions as .npy files in cache_dir (see
+        # load_cached). Loaded targs / preds / errors are then read-only
+        # memory maps.
+        self.use_file_cache = use_file_cache
+        self.cache_dir = cache_dir if cache_dir else os.path.join(output_dir, ".cache")
+        # dtype of preds / targs / errors. float32 is enough for display and
+        # error metrics and halves memory traffic, use np.float64 to get the
+        # same values as previous versions
+        self.dtype = dtype
+
         for model in self.models:
             if not model.logger_params:
                 model.logger_params = logger_params
 
-        # dict {dataset: target}
+        # dict {dataset: target}. Arrays must not be modified in place, they
+        # may be read-only (see use_file_cache)
         self.targs = {}
         # dict { dataset: {model: preds / errors}}
         self.preds = {}
         # signed error
         self.errors = {}
+        self.clear_caches()
+
+        # compile numeric kernels while the user is busy with the notebook
+        kernels.start_warm_up()
+
+    @property
+    def target_cols(self):
+        return self._target_cols
+
+    @target_cols.setter
+    def target_cols(self, target_cols):
+        self._target_cols = target_cols
+        # {label: feature id} for the UIs
+        self._target_col_ix = get_col_index(target_cols)
+
+    def clear_caches(self):
+        """
+        Forget values computed from preds / targs / errors by the UIs. Called
+        every time they are predicted or loaded again.
+        """
+        # {(dataset, model): error} anomalies were already computed for
+        self._anom_cache = {}
+        # cached anomalies keep their error alive
+        self.anomaly_params.clear_cache()
+        # {dataset: (normalized target, min of target, 1 / (max - min + eps))}
+        self._targ_norm = {}
+        # {dataset: (model names, stacked normalized preds)}
+        self._pred_norm_arr = {}
 
     def predict_all(self, override = False):
+        if not override and all(
+            datafile in self.preds
+            and all(model.sname in self.preds[datafile] for model in self.models)
+            for datafile in self.datafiles
+        ):
+            # everything is already in memory, targets are already shifted
+            self.logger_params.log_progress("skipping predict_all: all predictions already exist")
+            return
+
+        self.clear_caches()
+
         if not override:
             self.load_targets()
             self.load_preds_errors()
@@ -456,12 +771,15 @@ class TimeseriesPlot:
         # TODO move to predict() and one target by model
         self.targs = {i: self.targs[i][self.models[0].shift:,] for i in self.targs}
 
-        predicted_models = []
+        # [(model, datafiles)] actually predicted, the others are not dumped
+        # again so that their dump files (and caches) stay valid
+        predicted = []
 
         for model in self.logger_params.progress_bar(self.models):
             model.create_service()
+            to_predict = []
 
-            for datafile in self.logger_params.progress_bar(self.datafiles):
+            for datafile in self.datafiles:
                 if datafile not in self.preds:
                     self.preds[datafile] = {}
                     self.errors[datafile] = {}
@@ -470,63 +788,128 @@ class TimeseriesPlot:
                     self.logger_params.log_progress("skipping predict for %s with model %s: already exist" % (datafile, model.sname))
                     continue
 
-                datapath = os.path.join(self.datadir, datafile)
-
-                pred, targ = model.predict_file(datapath)
-
-                self.preds[datafile][model.sname] = pred
-                common_len = min(len(pred), len(targ))
-                self.errors[datafile][model.sname] = pred[:common_len] - targ[:common_len]
-                self.targs[datafile] = targ
-
-            predicted_models.append(model)
+                to_predict.append(datafile)
+
+            # requests to the service are I/O bound, so threads can overlap
+            # them when the model allows it
+            max_workers = self.max_workers if model.concurrent_predict else 1
+
+            with ThreadPoolExecutor(max_workers = max_workers) as executor:
+                futures = {
+                    executor.submit(model.predict_file, os.path.join(self.datadir, datafile)): datafile
+                    for datafile in to_predict
+                }
+
+                # results are stored from this thread only, no lock needed
+                for future in self.logger_params.progress_bar(as_completed(futures), total = len(futures)):
+                    datafile = futures[future]
+                    pred, targ = future.result()
+                    # Arrays are column major as signals are read one by one.
+                    pred = np.asfortranarray(pred, dtype = self.dtype)
+                    targ = np.asfortranarray(targ, dtype = self.dtype)
+
+                    self.preds[datafile][model.sname] = pred
+                    common_len = min(len(pred), len(targ))
+                    error = np.empty_like(pred[:common_len])
+                    np.subtract(pred[:common_len], targ[:common_len], out = error)
+                    self.errors[datafile][model.sname] = error
+                    self.targs[datafile] = targ
+
+            if to_predict:
+                predicted.append((model, to_predict))
             model.delete()
 
-        self.dump_model_preds(predicted_models)
+        for model, datafiles in predicted:
+            self.dump_model_preds([model], datafiles)
         self.logger_params.log_job_done()
 
-    def get_dump_filenames(self, datafile, model):
+    def get_dump_filenames(self, datafile, model, dump_format = None):
+        if dump_format is None:
+            dump_format = self.dump_format
+        ext = DUMP_FORMATS[dump_format]
+
         model_out_dir = os.path.join(self.output_dir, model.sname)
         dataname = os.path.splitext(datafile)[0]
         if hasattr(model, "autoregressive") and model.autoregressive.value:
-            pred_out_file = os.path.join(model_out_dir, dataname + "_pred_ar.csv")
-            err_out_file = os.path.join(model_out_dir, dataname + "_error_ar.csv")
+            pred_out_file = os.path.join(model_out_dir, dataname + "_pred_ar" + ext)
+            err_out_file = os.path.join(model_out_dir, dataname + "_error_ar" + ext)
         else:
-            pred_out_file = os.path.join(model_out_dir, dataname + "_pred.csv")
-            err_out_file = os.path.join(model_out_dir, dataname + "_error.csv")
+            pred_out_file = os.path.join(model_out_dir, dataname + "_pred" + ext)
+            err_out_file = os.path.join(model_out_dir, dataname + "_error" + ext)
         return pred_out_file, err_out_file
 
-    def dump_model_preds(self, models = None):
+    def find_dump_filenames(self, datafile, model):
+        """
+        Get dump filenames of existing predictions, trying dump_format first
+        and then the other formats (e.g. csv dumps from previous versions).
+        Return None if no predictions were dumped.
+        """
+        dump_formats = [self.dump_format] + [f for f in DUMP_FORMATS if f != self.dump_format]
+
+        for dump_format in dump_formats:
+            if dump_format == "parquet" and pq is None:
+                continue
+            pred_out_file, err_out_file = self.get_dump_filenames(datafile, model, dump_format)
+            if os.path.exists(pred_out_file):
+                return pred_out_file, err_out_file
+
+        return None
+
+    def dump_model_preds(self, models = None, datafiles = None):
         if not os.path.exists(self.output_dir):
             print("cannot dump predictions, directory %s does not exist" % self.output_dir)
             return
 
         if models == None:
             models = self.models
+        if datafiles is None:
+            datafiles = self.datafiles
 
         # models, preds, errors, datafiles, datadir, labels, output_dir,
-        for model in self.logger_params.progress_bar(models):
-            model_out_dir = os.path.join(self.output_dir, model.sname)
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            futures = []
 
-            # print("creating", model_out_dir, "...")
-            os.makedirs(model_out_dir, exist_ok = True)
+            for model in models:
+                model_out_dir = os.path.join(self.output_dir, model.sname)
 
-            for datafile in self.logger_params.progress_bar(self.datafiles):
-                pred_out_file, err_out_file = self.get_dump_filenames(datafile, model)
+                # print("creating", model_out_dir, "...")
+                os.makedirs(model_out_dir, exist_ok = True)
+
+                for datafile in datafiles:
+                    pred_out_file, err_out_file = self.get_dump_filenames(datafile, model)
+
+                    # needed if "test/"
+                    os.makedirs(os.path.dirname(pred_out_file), exist_ok = True)
 
-                # needed if "test/"
-                try:
-                    os.mkdir(os.path.dirname(pred_out_file))
-                except FileExistsError:
-                    pass
+                    futures.append(executor.submit(dump_data, self.preds[datafile][model.sname], self.target_cols, pred_out_file))
+                    futures.append(executor.submit(dump_data, self.errors[datafile][model.sname], self.target_cols, err_out_file))
 
-                dump_data(self.preds[datafile][model.sname], self.target_cols, pred_out_file)
-                dump_data(self.errors[datafile][model.sname], self.target_cols, err_out_file)
+            for future in self.logger_params.progress_bar(as_completed(futures), total = len(futures)):
+                # raise errors that happened while writing
+                future.result()
+
+    def load_file(self, path, loader, *params):
+        """
+        Load path with loader, through a cache in cache_dir if use_file_cache
+        is set.
+        params: parameters of the loader (columns, dtype...), so that
+            different loads of the same file do not share a cache
+        """
+        if not self.use_file_cache:
+            return loader(path)
+
+        key = get_cache_key(os.path.abspath(path), *params)
+        cache_prefix = os.path.join(self.cache_dir, os.path.basename(path) + "." + key)
+        return load_cached(path, loader, cache_prefix)
 
     def load_targets(self, columns = None):
         if columns is None:
             columns = self.target_cols
 
+        self.clear_caches()
+        columns = list(columns)
+        dtype_name = np.dtype(self.dtype).name
+
         # return dict for each datafile with target
         for datafile in self.logger_params.progress_bar(self.datafiles):
             targ_file = os.path.join(self.datadir, datafile)
@@ -534,9 +917,13 @@ class TimeseriesPlot:
                 self.logger_params.log_progress("cannot load target file %s: does not exist" % datafile)
                 continue
 
-            self.targs[datafile] = np.array(load_target(targ_file, columns))
+            self.targs[datafile] = self.load_file(targ_file, lambda path: load_target(path, columns, self.dtype), columns, dtype_name)
 
     def load_preds_errors(self):
+        self.clear_caches()
+        dtype_name = np.dtype(self.dtype).name
+        loader = lambda path: load_data(path, self.dtype)
+
         # return dict of dict for each datafile for each model
         for model in self.models:
             model_out_dir = os.path.join(self.output_dir, model.sname)
@@ -550,15 +937,18 @@ class TimeseriesPlot:
                     self.preds[datafile] = {}
                     self.errors[datafile] = {}
 
-                pred_out_file, err_out_file = self.get_dump_filenames(datafile, model)
+                dump_filenames = self.find_dump_filenames(datafile, model)
 
-                if not os.path.exists(pred_out_file):
+                if dump_filenames is None:
+                    pred_out_file, _ = self.get_dump_filenames(datafile, model)
                     self.logger_params.log_progress("cannot load predictions file %s" % pred_out_file)
                     continue
 
+                pred_out_file, err_out_file = dump_filenames
+
                 # FIXME pass columns to load_data (in case it changed before)
-                self.preds[datafile][model.sname] = load_data(pred_out_file)
-                self.errors[datafile][model.sname] = load_data(err_out_file)
+                self.preds[datafile][model.sname] = self.load_file(pred_out_file, loader, dtype_name)
+                self.errors[datafile][model.sname] = self.load_file(err_out_file, loader, dtype_name)
 
     def reset_pred_targ_error(self):
         """
@@ -567,6 +957,71 @@ class TimeseriesPlot:
         self.preds = {}
         self.targs = {}
         self.errors = {}
+        self.clear_caches()
+
+    def _get_target_bounds(self, dset):
+        if dset not in self._targ_norm:
+            targ = self.targs[dset]
+            min_targ, inv_range = kernels.minmax_bounds(targ)
+            self._targ_norm[dset] = (kernels.minmax_apply(targ, min_targ, inv_range), min_targ, inv_range)
+        return self._targ_norm[dset]
+
+    def get_normalized_target(self, dset):
+        """
+        Target of dataset dset normalized between 0 and 1. Computed once per
+        dataset.
+        """
+        return self._get_target_bounds(dset)[0]
+
+    def get_normalized_preds_array(self, dset):
+        """
+        Normalized predictions of dataset dset stacked with stack_preds(),
+        for all models that predicted the whole target. Used to compute
+        metrics of all models at once.
+        returns: list of model names, array (n_models, timesteps, n_features)
+        """
+        if dset not in self._pred_norm_arr:
+            preds = self.preds[dset]
+            targ_norm, min_targ, inv_range = self._get_target_bounds(dset)
+            same_len = {model_name: preds[model_name] for model_name in preds if len(preds[model_name]) == len(targ_norm)}
+
+            # normalize the stack in place, so that predictions are copied once
+            model_names, preds_arr = stack_preds(same_len)
+            if np.issubdtype(preds_arr.dtype, np.floating):
+                preds_arr -= min_targ
+                preds_arr *= inv_range
+            else:
+                preds_arr = kernels.minmax_apply(preds_arr, min_targ, inv_range)
+            self._pred_norm_arr[dset] = (model_names, preds_arr)
+        return self._pred_norm_arr[dset]
+
+    def get_all_anomalies(self, dset):
+        """
+        Compute anomalies of dataset dset for all models that predicted it.
+        Results are memoized by AnomalyParameters, so this is cheap when only
+        the displayed range changed; details are displayed the first time
+        only.
+        returns: dict {model_name: anomalies}
+        """
+        errors = self.errors[dset]
+        first_time = [m for m in errors if self._anom_cache.get((dset, m)) is not errors[m]]
+        compute = lambda m: self.anomaly_params.compute_anomalies_details(errors[m])
+
+        # signals are independent and mostly computed by numpy / scipy,
+        # which release the GIL
+        if len(errors) > 1 and kernels.parallel_threadsafe():
+            with ThreadPoolExecutor(max_workers = min(self.max_workers, len(errors))) as executor:
+                details = dict(zip(errors, executor.map(compute, errors)))
+        else:
+            details = {m: compute(m) for m in errors}
+
+        # details are printed / plotted in order, from this thread, with the
+        # error models fitted by the workers
+        for m in first_time:
+            self.anomaly_params.display_details(*details[m])
+            self._anom_cache[(dset, m)] = errors[m]
+
+        return {m: details[m][0] for m in errors}
 
     def learn_anomalies(self, model, datafiles):
         """
@@ -631,21 +1086,26 @@ class TimeseriesPlot:
         )
         out = widgets.Output(layout={'border': '1px solid black'})
 
+        # controls are displayed as one widget, so showing them is one message
+        controls = widgets.VBox([dataset_dropdown,
+                                 label_dropdown,
+                                 start_text,
+                                 duration_text,
+                                 run_button])
+
         def show_ui():
+            # wait = True: the previous output is cleared when the new one
+            # arrives, which avoids flickering
+            out.clear_output(wait = True)
             with out:
-                display(dataset_dropdown,
-                        label_dropdown,
-                        start_text,
-                        duration_text,
-                        run_button)
+                display(controls)
 
         def run_button_action(b):
-            out.clear_output()
             show_ui()
 
             start = start_text.value
             end = start_text.value + duration_text.value
-            feat = self.target_cols.index(label_dropdown.value)
+            feat = self._target_col_ix[label_dropdown.value]
             dset = dataset_dropdown.value
 
             signame = self.target_cols[feat]
@@ -670,7 +1130,7 @@ class TimeseriesPlot:
 
         for dset in self.logger_params.progress_bar(self.datafiles):
             for label in self.target_cols:
-                feat = self.target_cols.index(label)
+                feat = self._target_col_ix[label]
                 title = "%s - %s" % (dset, label)
 
                 if tstart:
@@ -740,19 +1200,20 @@ class TimeseriesPlot:
 
                 # TODO both testset and target anomalies are in green
                 if targ_anom:
-                    for a, b in targ_anom:
-                        a = max(tstart + model.shift, a)
-                        b = min(tend + model.shift, b)
+                    targ_bounds = np.asarray(targ_anom)
+                    a = np.maximum(targ_bounds[:,0], tstart + model.shift)
+                    b = np.minimum(targ_bounds[:,1], tend + model.shift)
+                    visible = a < b
 
-                        if a < b:
-                            ax1.axvspan(a, b, facecolor='green', alpha=0.3)
-                            ax2.axvspan(a, b, facecolor='green', alpha=0.3)
+                    for ax in [ax1, ax2]:
+                        add_vspans(ax, a[visible], b[visible], facecolor='green', alpha=0.3)
 
                 # plot anomaly
-                for i in anomaly:
-                    if tstart <= i < tend:
-                        ax1.axvspan(i - hwidth + model.shift, i + hwidth + model.shift, facecolor='red', alpha=0.3)
-                        ax2.axvspan(i - hwidth + model.shift, i + hwidth + model.shift, facecolor='red', alpha=0.3)
+                anomaly_arr = np.asarray(anomaly)
+                anoms = anomaly_arr[(tstart <= anomaly_arr) & (anomaly_arr < tend)] + model.shift
+
+                for ax in [ax1, ax2]:
+                    add_vspans(ax, anoms - hwidth, anoms + hwidth, facecolor='red', alpha=0.3)
 
                 if ano_signal is not None:
                     # ano_signal = ano_signal / max(0.0001, np.max(np.absolute(ano_signal))) * np.max(target)
@@ -760,8 +1221,9 @@ class TimeseriesPlot:
 
                     if ano_peaks is not None:
                         ano_peaks = ano_peaks[np.logical_and(tstart < ano_peaks, ano_peaks < tend)]
-                        ano_peaks_good = ano_peaks[np.in1d(ano_peaks, anomaly)]
-                        ano_peaks_bad = ano_peaks[~np.in1d(ano_peaks, anomaly)]
+                        is_anomaly = isin_sorted(ano_peaks, np.sort(anomaly))
+                        ano_peaks_good = ano_peaks[is_anomaly]
+                        ano_peaks_bad = ano_peaks[~is_anomaly]
                         ax2.scatter(ano_peaks_good + model.shift, ano_signal[ano_peaks_good], label = "anomaly", c="red", marker='x', zorder = 3)
                         # ax.scatter(ano_peaks_bad, ano_signal[ano_peaks_bad], label = "peak", c="blue", marker='x', zorder = 3)
             else: # anomalies
@@ -773,12 +1235,11 @@ class TimeseriesPlot:
 
             ax2.legend()
 
-            for ax in [ax1, ax2]:
-                if tests:
-                    for test_start, test_end in tests:
-                        test_start = min(max(test_start, tstart), tend)
-                        test_end = min(max(test_end, tstart), tend)
-                        ax.axvspan(test_start + model.shift, test_end + model.shift, facecolor='green', alpha=0.3)
+            if tests:
+                test_bounds = np.clip(np.asarray(tests), tstart, tend) + model.shift
+
+                for ax in [ax1, ax2]:
+                    add_vspans(ax, test_bounds[:,0], test_bounds[:,1], facecolor='green', alpha=0.3)
 
             if self.plot_params.ylim:
                 ax1.set_ylim(self.plot_params.ylim)
@@ -823,21 +1284,29 @@ class TimeseriesPlot:
 
         out = widgets.Output(layout={'border': '1px solid black'})
 
+        controls = widgets.VBox([dataset_dropdown,
+                                 label_dropdown,
+                                 start_text,
+                                 duration_text,
+                                 run_button])
+
         def show_ui():
-            out.clear_output()
+            out.clear_output(wait = True)
             with out:
-                display(dataset_dropdown,
-                        label_dropdown,
-                        start_text,
-                        duration_text,
-                        run_button)
+                display(controls)
+
+        # {model_name: buffer} for absolute errors
+        abs_buffers = {}
 
         def run_button_action(b):
             show_ui()
 
-            start = start_text.value - self.models[0].shift
-            end = start_text.value + duration_text.value - self.models[0].shift
-            feat = self.target_cols.index(label_dropdown.value)
+            m0 = self.models[0]
+            shift = m0.shift
+            sname0 = m0.sname
+            start = start_text.value - shift
+            end = start_text.value + duration_text.value - shift
+            feat = self._target_col_ix[label_dropdown.value]
             dset = dataset_dropdown.value
             # avg_alpha = avg_alpha_text.value
             # ano_method = anomaly_dropdown.value
@@ -846,29 +1315,39 @@ class TimeseriesPlot:
             pred = self.preds[dset]
             targ = self.targs[dset]
             error_nabs = self.errors[dset]
-            error = {model_name: np.absolute(error_nabs[model_name]) for model_name in error_nabs}
+            error = {}
+
+            for model_name in error_nabs:
+                signed_error = error_nabs[model_name]
+                # reuse the buffers of the previous update when possible
+                buf = abs_buffers.get(model_name)
+                if buf is None or buf.shape != signed_error.shape or buf.dtype != signed_error.dtype:
+                    buf = np.empty_like(signed_error)
+                    abs_buffers[model_name] = buf
+                error[model_name] = np.abs(signed_error, out = buf)
             # test_sets = get_test_sets(targs) if "test/" not in dset else []
 
-            pred_norm,targ_norm, error_norm = {}, None, {}
             # error_norm = {i : error[i] / np.mean(np.absolute(targ), axis=0) for i in error}
+            targ_norm = self.get_normalized_target(dset)
 
-            for model_name in pred:
-                pred_norm[model_name], targ_norm = normalize_data(pred[model_name], targ)
-                error_norm[model_name] = normalize_error(error[model_name])
-
-            pred_len = pred[self.models[0].sname].shape[0]
+            pred_len = pred[sname0].shape[0]
 
             if end > pred_len or duration_text.value <= 0:
                 end = pred_len
 
             with out:
-                print("n features: %d, n signals: %d" % (targ.shape[1], pred_len))
-                print("selected feature: %d" % feat)
-                for model_name in pred:
-                    if len(pred_norm[model_name]) == len(targ_norm):
-                        print("mean error for %s: %f" % (model_name, get_signal_mean_error(pred_norm[model_name], targ_norm, feat)))
+                model_names, pred_norm_arr = self.get_normalized_preds_array(dset)
+                mean_errors = get_stacked_mean_error(pred_norm_arr, targ_norm, feat)
+
+                # one print, the output widget is updated only once
+                print(
+                    f"n features: {targ.shape[1]}, n signals: {pred_len}\n"
+                    f"selected feature: {feat}\n"
+                    + "\n".join(f"mean error for {model_name}: {mean_error:f}"
+                                for model_name, mean_error in zip(model_names, mean_errors))
+                )
 
-                title = "%s signal from %d to %d " % (signame, start + self.models[0].shift, end + self.models[0].shift)
+                title = f"{signame} signal from {start + shift} to {end + shift} "
                 self.plot_predictions(pred, targ, error, [feat], start, end, title)
 
         run_button.on_click(run_button_action)
@@ -912,46 +1391,54 @@ class TimeseriesPlot:
 
         out = widgets.Output(layout={'border': '1px solid black'})
 
+        controls = widgets.VBox([dataset_dropdown,
+                                 label_dropdown,
+                                 start_text,
+                                 duration_text,
+                                 run_button])
+
         def show_ui():
-            out.clear_output()
+            out.clear_output(wait = True)
             with out:
-                display(dataset_dropdown,
-                        label_dropdown,
-                        start_text,
-                        duration_text,
-                        run_button)
+                display(controls)
 
         def run_button_action(b):
             show_ui()
 
-            start = start_text.value - self.models[0].shift
-            end = start_text.value + duration_text.value - self.models[0].shift
-            feat = self.target_cols.index(label_dropdown.value)
+            m0 = self.models[0]
+            shift = m0.shift
+            sname0 = m0.sname
+            start = start_text.value - shift
+            end = start_text.value + duration_text.value - shift
+            feat = self._target_col_ix[label_dropdown.value]
             dset = dataset_dropdown.value
 
             signame = self.target_cols[feat]
             pred = self.preds[dset]
             targ = self.targs[dset]
-            error = self.errors[dset]
 
-            pred_len = pred[self.models[0].sname].shape[0]
+            pred_len = pred[sname0].shape[0]
 
             if end > pred_len or duration_text.value <= 0:
                 end = pred_len
 
             with out:
-                print("n features: %d, n signals: %d" % (targ.shape[1], pred_len))
-                print("selected feature: %d" % feat)
+                msg = (f"n features: {targ.shape[1]}, n signals: {pred_len}\n"
+                       f"selected feature: {feat}")
 
-                # Anomalies detection
-                anomalies = {i: self.anomaly_params.compute_anomalies(error[i], display = True) for i in error}
+                # Anomalies detection, cached by AnomalyParameters while the
+                # errors and parameters are the same
+                anomalies = self.get_all_anomalies(dset)
 
                 if targ_anom:
                     for i in anomalies:
-                        pred_anom = [ano + self.models[0].shift for ano in anomalies[i][0]]
-                        print("true pos, false neg, false pos:", self.anomaly_params.get_anomaly_results(pred_anom, targ_anom))
+                        pred_anom = np.asarray(anomalies[i][0], dtype=np.int64) + shift
+                        msg += f"\ntrue pos, false neg, false pos: {self.anomaly_params.get_anomaly_results(pred_anom, targ_anom)}"
 
-                title = "%s signal from %d to %d " % (signame, start + self.models[0].shift, end + self.models[0].shift)
+                # one print, the output widget is updated only once
+                print(msg)
+
+                title = f"{signame} signal from {start + shift} to {end + shift} "
                 # normalize_error = normalize only one signal. The name can be changed in the future.
                 self.plot_predictions(pred, targ, None, [feat], start, end, title, anomalies, targ_anom)
 
@@ -964,13 +1451,16 @@ class TimeseriesPlot:
         """
         Save all signals prediction graph
         """
+        m0 = self.models[0]
+        shift = m0.shift
+        sname0 = m0.sname
         max_i =  targ.shape[0] - 1 - shift
 
-        for feat in range(targ.shape[1]):
-            # compute mean error
-            pred_norm, targ_norm = normalize_data(pred[models[0]][:,feat], targ[:,feat])
-            mean_error = np.mean(np.absolute(targ_norm - pred_norm))
+        # one pass per signal, without normalized copies of pred and targ
+        mean_errors = [get_signal_mean_error(pred[sname0], targ, feat) for feat in range(targ.shape[1])]
+
+        signames = [self.target_cols[feat] + "_" + str(mean_errors[feat]) for feat in range(targ.shape[1])]
 
-            signame = self.target_cols[feat] + "_" + str(mean_error)
+        for feat, signame in enumerate(signames):
             print(signame)
-            self.display_compare(pred, targ, error, [feat], 0, max_i, signame + " whole signal", tests = test_sets, save = dest + signame + ".png")
+            self.plot_predictions(pred, targ, error, [feat], 0, max_i, signame + " whole signal", tests = test_sets, save = dest + signame + ".png")
@@ -1,9 +1,17 @@
 
 import numpy as np
 import scipy
+import scipy.ndimage
+import scipy.signal
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 
+try:
+    import bottleneck as bn
+except ImportError:
+    # bottleneck is optional, scipy is used instead
+    bn = None
+
 # Anomaly detection
 
 def exp_mean_avg(x, alpha):
@@ -20,13 +28,39 @@ def id_from_timestamp(ts, ts_bounds, max_id):
 
 def sum_conv_error(error, conv = None):
     err_sum = np.sum(error, axis=1)
-    if conv != None:
-        err_sum = np.convolve(err_sum, conv, mode="same")
+    if conv is not None:
+        err_sum = scipy.signal.convolve(err_sum, conv, mode="same")
     return err_sum
 
+def moving_average(x, window, axis = 0):
+    """
+    Centered moving average of x along axis. Values outside of x are
+    considered to be 0, so that the result is the same as
+    np.convolve(x, [1 / window] * window, mode="same") on each signal.
+    """
+    x = np.asarray(x)
+    if not np.issubdtype(x.dtype, np.floating):
+        x = x.astype(np.float64)
+
+    if x.shape[axis] == 0:
+        return x.astype(x.dtype)
+
+    if bn is None:
+        return scipy.ndimage.uniform_filter1d(x, size=window, axis=axis, mode="constant")
+
+    # bottleneck windows are trailing: pad the end and shift the result
+    # back by half a window to center it
+    half = (window - 1) // 2
+    pad = [(0, 0)] * x.ndim
+    pad[axis] = (0, half)
+    sums = bn.move_sum(np.pad(x, pad), window=window, min_count=1, axis=axis)
+    sums = np.take(sums, np.arange(half, half + x.shape[axis]), axis=axis)
+    sums /= window
+    return sums
+
 def conv_error(error, conv = None):
-    if conv != None:
-        error = np.convolve(error, conv, mode="same")
+    if conv is not None:
+        error = scipy.signal.convolve(error, conv, mode="same")
     return error
 
 
@@ -44,48 +78,58 @@ def gauss(x, *p):
     A, mu, sigma = p
     return A*np.exp(-(x-mu)**2/(2.*sigma**2))
 
-def build_gauss_error_model(error, nbuckets = 100, display = False):
+def error_distribution(error, nbuckets = 100, fit_gauss = False):
+    """
+    Statistics and histogram of error, with a gaussian fitted on the
+    histogram if fit_gauss is set.
+    returns: (mean, max, min, sd) of error, gaussian coefficients,
+        histogram bins and values
+    """
     mean_error = np.mean(error)
     sd_error = np.sqrt(np.mean((error - mean_error)**2))
     max_error = np.max(error)
     min_error = np.min(error)
 
-    if display:
-        print("mean error: " + str(mean_error))
-        print("max error: " + str(max_error))
-        print("min error: " + str(min_error))
-        print("sd error: " + str(sd_error))
-
     hist, bin_edges = np.histogram(error, nbuckets, density=True)
     bin_centres = (bin_edges[:-1] + bin_edges[1:])/2
     default_A = max(hist)
 
-    p0 = [default_A, mean_error, sd_error]
-    coeff, var_matrix = curve_fit(gauss, bin_centres, hist, p0=p0, method='trf')
-
-    if display:
+    if fit_gauss:
+        p0 = [default_A, mean_error, sd_error]
+        coeff, var_matrix = curve_fit(gauss, bin_centres, hist, p0=p0, method='trf')
+    else:
+        coeff = (default_A, mean_error, sd_error)
+
+    return (mean_error, max_error, min_error, sd_error), coeff, bin_centres, hist
+
+def print_error_distribution(stats, coeff = None):
+    """
+    Print statistics returned by error_distribution(), and the fitted
+    gaussian if coeff is given
+    """
+    mean_error, max_error, min_error, sd_error = stats
+    print("mean error: " + str(mean_error))
+    print("max error: " + str(max_error))
+    print("min error: " + str(min_error))
+    print("sd error: " + str(sd_error))
+
+    if coeff is not None:
         print('fitted mean = ' + str(coeff[1]))
         print('fitted stddev = ' + str(coeff[2]))
 
+def build_gauss_error_model(error, nbuckets = 100, display = False):
+    stats, coeff, bin_centres, hist = error_distribution(error, nbuckets, fit_gauss = True)
+
+    if display:
+        print_error_distribution(stats, coeff)
+
     return coeff, bin_centres, hist
 
 def get_error_distribution(error, nbuckets = 100, display = False):
-    mean_error = np.mean(error)
-    sd_error = np.sqrt(np.mean((error - mean_error)**2))
-    max_error = np.max(error)
-    min_error = np.min(error)
+    stats, coeff, bin_centres, hist = error_distribution(error, nbuckets)
 
     if display:
-        print("mean error: " + str(mean_error))
-        print("max error: " + str(max_error))
-        print("min error: " + str(min_error))
-        print("sd error: " + str(sd_error))
-
-    hist, bin_edges = np.histogram(error, nbuckets, density=True)
-    bin_centres = (bin_edges[:-1] + bin_edges[1:])/2
-
-    default_A = max(hist)
-    coeff = (default_A, mean_error, sd_error)
+        print_error_distribution(stats)
 
     return coeff, bin_centres, hist
 
@@ -106,24 +150,38 @@ def display_error_distribution(bins, hist, coeff, title = "", xmin = -10, xmax =
 class ErrorNormalizationModel:
     def __init__(self):
         self.coeffs = []
+        self.distributions = []
+        self.fit_gauss = False
 
     def fit(self, error, conv = None, fit_gauss = False, display = False):
         self.coeffs = []
+        # error_distribution() of each signal, kept for display_fit()
+        self.distributions = []
+        self.fit_gauss = fit_gauss
 
         for i in range(error.shape[1]):
             error_i = error[:,i]
             error_i = conv_error(error_i, conv)
-            if fit_gauss:
-                coeff, bins, hist = build_gauss_error_model(error_i, display = display)
-            else:
-                coeff, bins, hist = get_error_distribution(error_i, display = display)
-            _, mean, stddev = coeff
+            self.distributions.append(error_distribution(error_i, fit_gauss = fit_gauss))
+            _, mean, stddev = self.distributions[-1][1]
 
             if display:
-                display_error_distribution(bins, hist, coeff, "error distribution")
+                self.display_fit(i)
 
             self.coeffs.append((mean, stddev))
 
+    def display_fit(self, signal = None):
+        """
+        Display the error distributions the model was fitted on.
+        signal: index of the signal to display, all signals if None
+        """
+        signals = range(len(self.distributions)) if signal is None else [signal]
+
+        for i in signals:
+            stats, coeff, bins, hist = self.distributions[i]
+            print_error_distribution(stats, coeff if self.fit_gauss else None)
+            display_error_distribution(bins, hist, coeff, "error distribution")
+
     def anomaly_dates(self, error, stddev_threshold = 3, conv = None, display = False):
         error_dev = np.zeros(error.shape[0])
         total = 0
@@ -156,8 +214,8 @@ def error_vote(error,nvotes,weight=True, conv = None):
                 votes[ti] = votes[ti]+1*error[ti,signal]
             else:
                 votes[ti] = votes[ti]+1
-    if conv != None:
-        votes = np.convolve(votes, conv, mode="same")
+    if conv is not None:
+        votes = scipy.signal.convolve(votes, conv, mode="same")
     return votes
 
 def anomaly_dates_votes(votes,nanomalies):
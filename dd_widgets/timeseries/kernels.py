@@ -0,0 +1,381 @@
+
+import threading
+import numpy as np
+
+from .._jit import HAS_NUMBA, maybe_njit, numba, prange
+
+try:
+    # ahead of time compiled kernels, see dd_widgets/_kernels_build.py
+    from .. import dd_kernels as _aot
+except ImportError:
+    _aot = None
+
+NORM_EPS = 1E-5
+
+# {dtype: suffix} of the dtypes kernels are compiled for (suffix of the
+# kernels exported by dd_kernels)
+AOT_TYPES = {np.dtype(np.float32): "f4", np.dtype(np.float64): "f8"}
+
+# kernels compiled with parallel=True. With numba's TBB threading layer,
+# the process hangs at exit if they were compiled from another thread than
+# the main one, so they are only compiled by compile_parallel(), called
+# from the main thread.
+PARALLEL_KERNELS = ["minmax_norm", "minmax_norm_pair", "minmax_bounds"]
+
+# set by warm_up() once the sequential JIT kernels are compiled
+_warm_up_done = threading.Event()
+# set by compile_parallel() once the parallel JIT kernels are compiled
+_parallel_compiled = threading.Event()
+_compile_lock = threading.Lock()
+_warm_up_lock = threading.Lock()
+
+def _get_kernel(name, dtype):
+    """
+    returns: the compiled kernel name for dtype, None if there is none. The
+        ahead of time compiled kernel is used while the JIT one is not
+        compiled and cannot be compiled from this thread.
+    """
+    if dtype not in AOT_TYPES:
+        return None
+
+    aot_func = None
+    if _aot is not None:
+        aot_func = getattr(_aot, name + "_" + AOT_TYPES[dtype], None)
+
+    if not HAS_NUMBA:
+        return aot_func
+
+    if name in PARALLEL_KERNELS:
+        if not _parallel_compiled.is_set():
+            if threading.current_thread() is not threading.main_thread():
+                return aot_func
+            compile_parallel()
+    elif aot_func is not None and not _warm_up_done.is_set():
+        return aot_func
+
+    return globals()["_" + name]
+
+# Min / max normalization
+
+@maybe_njit(parallel=True, fastmath=True)
+def _minmax_norm(data, out, eps):
+    n, m = data.shape
+    for j in prange(m):
+        mn = data[0,j]
+        mx = mn
+        for i in range(1, n):
+            v = data[i,j]
+            if v < mn:
+                mn = v
+            elif v > mx:
+                mx = v
+        inv = 1.0 / (mx - mn + eps)
+        for i in range(n):
+            out[i,j] = (data[i,j] - mn) * inv
+
+@maybe_njit(parallel=True, fastmath=True)
+def _minmax_norm_pair(ref, data, out_ref, out_data, eps):
+    n, m = ref.shape
+    for j in prange(m):
+        mn = ref[0,j]
+        mx = mn
+        for i in range(1, n):
+            v = ref[i,j]
+            if v < mn:
+                mn = v
+            elif v > mx:
+                mx = v
+        inv = 1.0 / (mx - mn + eps)
+        for i in range(n):
+            out_ref[i,j] = (ref[i,j] - mn) * inv
+        for i in range(data.shape[0]):
+            out_data[i,j] = (data[i,j] - mn) * inv
+
+@maybe_njit(parallel=True, fastmath=True)
+def _minmax_bounds(data, min_out, inv_out, eps):
+    n, m = data.shape
+    for j in prange(m):
+        mn = data[0,j]
+        mx = mn
+        for i in range(1, n):
+            v = data[i,j]
+            if v < mn:
+                mn = v
+            elif v > mx:
+                mx = v
+        min_out[j] = mn
+        inv_out[j] = 1.0 / (mx - mn + eps)
+
+def _float_dtype(*arrays):
+    dtype = np.result_type(*arrays)
+    return dtype if np.issubdtype(dtype, np.floating) else np.float64
+
+def minmax_norm(data, eps = NORM_EPS):
+    """
+    Normalize each column of data between 0 and 1.
+    """
+    data = np.asarray(data)
+    dtype = _float_dtype(data)
+    kernel = _get_kernel("minmax_norm", dtype)
+
+    if kernel is None or data.size == 0:
+        min_data = np.min(data, axis=0)
+        norm_data = np.subtract(data, min_data, dtype=dtype)
+        norm_data /= np.max(data, axis=0) - min_data + eps
+        return norm_data
+
+    data = data.astype(dtype, copy=False)
+    data2d = data.reshape(data.shape[0], -1)
+    out = np.empty(data2d.shape, dtype=dtype)
+    kernel(data2d, out, eps)
+    return out.reshape(data.shape)
+
+def minmax_norm_pair(data, ref, eps = NORM_EPS):
+    """
+    Normalize each column of data and ref with min and max of the
+    corresponding column in ref.
+    returns: normalized data, normalized ref
+    """
+    data = np.asarray(data)
+    ref = np.asarray(ref)
+    dtype = _float_dtype(data, ref)
+
+    if data.shape[1:] != ref.shape[1:]:
+        raise ValueError(
+            "Cannot normalize data of shape %s with reference of shape %s"
+            % (data.shape, ref.shape)
+        )
+
+    kernel = _get_kernel("minmax_norm_pair", dtype)
+
+    if kernel is None or ref.size == 0:
+        min_ref = np.min(ref, axis=0)
+        range_ref = np.max(ref, axis=0) - min_ref + eps
+        norm_data = np.subtract(data, min_ref, dtype=dtype)
+        norm_data /= range_ref
+        norm_ref = np.subtract(ref, min_ref, dtype=dtype)
+        norm_ref /= range_ref
+        return norm_data, norm_ref
+
+    data = data.astype(dtype, copy=False)
+    ref = ref.astype(dtype, copy=False)
+    data2d = data.reshape(data.shape[0], -1)
+    ref2d = ref.reshape(ref.shape[0], -1)
+    out_data = np.empty(data2d.shape, dtype=dtype)
+    out_ref = np.empty(ref2d.shape, dtype=dtype)
+    kernel(ref2d, data2d, out_ref, out_data, eps)
+    return out_data.reshape(data.shape), out_ref.reshape(ref.shape)
+
+def minmax_bounds(ref, eps = NORM_EPS):
+    """
+    Compute what is needed to normalize data with min and max of ref, once
+    for all the arrays normalized with the same reference.
+    returns: min of each column of ref, 1 / (max - min + eps) of each column
+    """
+    ref = np.asarray(ref)
+    dtype = _float_dtype(ref)
+    kernel = _get_kernel("minmax_bounds", dtype)
+
+    if kernel is None or ref.size == 0:
+        min_ref = np.min(ref, axis=0)
+        inv_range = np.reciprocal(np.subtract(np.max(ref, axis=0), min_ref, dtype=dtype) + eps)
+        return min_ref.astype(dtype, copy=False), inv_range
+
+    ref = ref.astype(dtype, copy=False)
+    ref2d = ref.reshape(ref.shape[0], -1)
+    min_ref = np.empty(ref2d.shape[1], dtype=dtype)
+    inv_range = np.empty(ref2d.shape[1], dtype=dtype)
+    kernel(ref2d, min_ref, inv_range, eps)
+    return min_ref.reshape(ref.shape[1:]), inv_range.reshape(ref.shape[1:])
+
+def minmax_apply(data, min_ref, inv_range):
+    """
+    Normalize data with bounds returned by minmax_bounds()
+    """
+    norm_data = np.subtract(data, min_ref, dtype=_float_dtype(data, min_ref))
+    norm_data *= inv_range
+    return norm_data
+
+
+# Errors
+
+@maybe_njit(fastmath=True)
+def _mean_abs_error_norm(pred, targ, eps):
+    # |norm(t) - norm(p)| = |t - p| / (max - min + eps), so min, max
+    # and the error sum are all computed in the same pass
+    n = targ.shape[0]
+    mn = targ[0]
+    mx = mn
+    s = 0.0
+    for i in range(n):
+        v = targ[i]
+        if v < mn:
+            mn = v
+        elif v > mx:
+            mx = v
+        s += abs(v - pred[i])
+    return s / n / (mx - mn + eps)
+
+@maybe_njit()
+def _anomaly_results(pred, starts, ends):
+    found = np.zeros(starts.shape[0], dtype=np.bool_)
+    fp = 0
+    for k in range(pred.shape[0]):
+        i = np.searchsorted(starts, pred[k], side="right") - 1
+        if i >= 0 and pred[k] <= ends[i]:
+            found[i] = True
+        else:
+            fp += 1
+    tp = 0
+    for i in range(found.shape[0]):
+        if found[i]:
+            tp += 1
+    return tp, starts.shape[0] - tp, fp
+
+def mean_abs_error_norm(pred, targ, eps = NORM_EPS):
+    """
+    Mean absolute error between 1D pred and targ, after normalizing both
+    with min / max of targ
+    """
+    pred = np.asarray(pred)
+    targ = np.asarray(targ)
+
+    if pred.shape != targ.shape:
+        raise ValueError("pred and targ shapes differ: %s, %s" % (pred.shape, targ.shape))
+
+    dtype = _float_dtype(pred, targ)
+    kernel = _get_kernel("mean_abs_error_norm", dtype)
+
+    if kernel is None or targ.ndim != 1 or targ.size == 0:
+        diff = np.subtract(targ, pred, dtype=dtype)
+        np.absolute(diff, out=diff)
+        return np.mean(diff, axis=0) / (np.max(targ, axis=0) - np.min(targ, axis=0) + eps)
+
+    return kernel(pred.astype(dtype, copy=False), targ.astype(dtype, copy=False), eps)
+
+def anomaly_results(pred, starts, ends):
+    """
+    Count anomalies found in the intervals [starts[i], ends[i]].
+    starts must be sorted and the intervals must not overlap.
+    returns: true positive, false negative, false positive
+    """
+    # dtypes the kernel is compiled for
+    dtype = np.int64 if np.issubdtype(np.result_type(pred, starts, ends), np.integer) else np.float64
+    pred = np.ascontiguousarray(pred, dtype=dtype)
+    starts = np.ascontiguousarray(starts, dtype=dtype)
+    ends = np.ascontiguousarray(ends, dtype=dtype)
+
+    if len(starts) == 0:
+        return 0, 0, len(pred)
+
+    if HAS_NUMBA:
+        return _anomaly_results(pred, starts, ends)
+
+    # last interval starting before each predicted anomaly
+    idx = np.searchsorted(starts, pred, side="right") - 1
+    valid = (idx >= 0) & (pred <= ends[np.clip(idx, 0, None)])
+
+    found = np.zeros(len(starts), dtype=bool)
+    found[idx[valid]] = True
+
+    tp = int(found.sum())
+    return tp, len(starts) - tp, int((~valid).sum())
+
+def parallel_threadsafe():
+    """
+    returns: True if the kernels can be called from several threads at
+        once. numba's workqueue threading layer (used when neither TBB nor
+        OpenMP is available) aborts the process when parallel kernels are
+        launched concurrently.
+    """
+    if not HAS_NUMBA:
+        return True
+
+    try:
+        layer = numba.threading_layer()
+    except ValueError:
+        # the layer is chosen when a parallel kernel first runs
+        minmax_norm(np.zeros((1, 1)))
+        try:
+            layer = numba.threading_layer()
+        except ValueError:
+            # not called from the main thread, no parallel kernel ran
+            return False
+    return layer != "workqueue"
+
+def _array_type(dtype, ndim, readonly = False):
+    # any layout, so that slices, C and fortran arrays share compiled code
+    return numba.types.Array(numba.from_dtype(dtype), ndim, "A", readonly = readonly)
+
+# Kernels are compiled for read-only inputs of any layout, so that memory
+# maps (see load_cached), slices, C and fortran arrays share compiled code.
+# Compilation is then disabled: calls convert their arrays to these
+# signatures instead of compiling a specialization of their own.
+
+def compile_parallel():
+    """
+    Compile the parallel kernels (or load them from numba cache). Must be
+    called from the main thread, the first call of a parallel kernel from
+    the main thread does it.
+    """
+    if not HAS_NUMBA:
+        return
+
+    with _compile_lock:
+        if _parallel_compiled.is_set():
+            return
+
+        eps = numba.types.float64
+        for dtype in AOT_TYPES:
+            in2 = _array_type(dtype, 2, True)
+            out1, out2 = _array_type(dtype, 1), _array_type(dtype, 2)
+
+            _minmax_norm.compile((in2, out2, eps))
+            _minmax_norm_pair.compile((in2, in2, out2, out2, eps))
+            _minmax_bounds.compile((in2, out1, out1, eps))
+
+        for kernel in [_minmax_norm, _minmax_norm_pair, _minmax_bounds]:
+            kernel.disable_compile()
+
+        _parallel_compiled.set()
+
+def warm_up():
+    """
+    Compile the sequential kernels (or load them from numba cache), so that
+    the first UI update does not wait for them. Kernels are only compiled,
+    not run, so this is safe to do from a background thread while they are
+    used. Parallel kernels are left to compile_parallel().
+    """
+    if not HAS_NUMBA:
+        return
+
+    # compilation is disabled once done, so it must only be done once
+    with _warm_up_lock:
+        if _warm_up_done.is_set():
+            return
+
+        eps = numba.types.float64
+        for dtype in AOT_TYPES:
+            in1 = _array_type(dtype, 1, True)
+            _mean_abs_error_norm.compile((in1, in1, eps))
+
+        for dtype in [np.int64, np.float64]:
+            in1 = _array_type(dtype, 1, True)
+            _anomaly_results.compile((in1, in1, in1))
+
+        for kernel in [_mean_abs_error_norm, _anomaly_results]:
+            kernel.disable_compile()
+
+        _warm_up_done.set()
+
+_warm_up_thread = None
+
+def start_warm_up():
+    """
+    Run warm_up() once, in a background thread
+    """
+    global _warm_up_thread
+
+    if HAS_NUMBA and _warm_up_thread is None:
+        _warm_up_thread = threading.Thread(target=warm_up, daemon=True)
+        _warm_up_thread.start()
@@ -152,9 +152,7 @@ class LSTM(Timeseries):
         csvfile = open(datafile)
         csv_reader = csv.reader(csvfile, delimiter=',')
         header = next(csv_reader)
-        col_labels = []
-        for l in eval(self.label_columns.value):
-            col_labels.append(get_col(header,l))
+        col_labels = get_cols(header, eval(self.label_columns.value))
 
         nsteps = 0
         csvheader=io.StringIO()
@@ -215,9 +213,7 @@ class LSTM(Timeseries):
         csvfile = open(datafile)
         csv_reader = csv.reader(csvfile, delimiter=',')
         header = next(csv_reader)
-        col_labels = []
-        for l in labels:
-            col_labels.append(get_col(header,l))
+        col_labels = get_cols(header, labels)
 
         nsteps = 0
         csvheader=io.StringIO()
@@ -12,6 +12,8 @@ from tqdm import notebook
 from . import *
 
 class NBEATS(Timeseries):
+    # sliding window predictions do not depend on each other
+    concurrent_predict = True
 
     def __init__(self,
                 sname: str,
@@ -172,10 +174,9 @@ class NBEATS(Timeseries):
                 raw_data.append(data)
             raw_data = np.array(raw_data, dtype=np.double)
 
-        col_labels = []
-        for l in header:
-            if l not in eval(self.ignore_columns.value):
-                col_labels.append(get_col(header,l))
+        ignored = frozenset(eval(self.ignore_columns.value))
+        header_idx = get_col_index(header)
+        col_labels = [header_idx[l] for l in header if l not in ignored]
 
         npoints = num_lines-backcast
         nlabels = len(col_labels)
@@ -259,10 +260,9 @@ class NBEATS(Timeseries):
                 raw_data.append(data)
             raw_data = np.array(raw_data, dtype=np.double)
 
-        col_labels = []
-        for l in header:
-            if l not in eval(self.ignore_columns.value):
-                col_labels.append(get_col(header,l))
+        ignored = frozenset(eval(self.ignore_columns.value))
+        header_idx = get_col_index(header)
+        col_labels = [header_idx[l] for l in header if l not in ignored]
 
         npoints = stop - start
         ntarg = min(npoints, num_lines - backcast)
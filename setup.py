@@ -1,13 +1,33 @@
+import importlib.util
+import os
+
 from setuptools import setup, find_packages
 
 with open("requirements.txt") as fh:
     requirements = [line.strip() for line in fh.readlines()]
 
+ext_modules = []
+if os.environ.get("DD_WIDGETS_BUILD_KERNELS") == "1":
+    # opt-in ahead of time compiled kernels (dd_widgets.dd_kernels), needs
+    # numba and a C compiler. The build script is loaded by path: importing
+    # dd_widgets needs its run time dependencies and a notebook environment.
+    spec = importlib.util.spec_from_file_location(
+        "dd_widgets._kernels_build", os.path.join("dd_widgets", "_kernels_build.py"))
+    kernels_build = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(kernels_build)
+
+    kernels_ext = kernels_build.cc.distutils_extension()
+    # a failed build only skips the extension: the kernels are then
+    # compiled by numba at run time or replaced by numpy code
+    kernels_ext.optional = True
+    ext_modules.append(kernels_ext)
+
 setup(
     name="dd_widgets",
     version=0.1,
     description="IPython widgets for deepdetect",
     packages=find_packages(),
     install_requires=requirements,
+    ext_modules=ext_modules,
     python_requires=">=3.5",
 )
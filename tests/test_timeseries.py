@@ -0,0 +1,358 @@
+import os
+
+import numpy as np
+import pytest
+
+from dd_widgets.timeseries import (AnomalyParameters, LoggerParameters, TimeseriesPlot,
+                                   anomalies, dump_data, get_signal_mean_error,
+                                   get_stacked_mean_error, kernels, load_cached, stack_preds)
+
+
+# Reference implementations (previous numpy / python code)
+
+def ref_moving_average(x, window):
+    conv = [1 / window] * window
+    return np.stack([np.convolve(x[:,i], conv, mode="same") for i in range(x.shape[1])], axis=1)
+
+def ref_minmax_norm(data):
+    eps = 1E-5
+    max_data = np.amax(data,axis=0)
+    min_data = np.min(data,axis=0)
+    return np.divide((data-min_data),(max_data-min_data+eps))
+
+def ref_minmax_norm_pair(pred, targ):
+    eps = 1E-5
+    max_data = np.amax(targ,axis=0)
+    min_data = np.min(targ,axis=0)
+    norm_pred = np.divide((pred-min_data),(max_data-min_data+eps))
+    norm_targ = np.divide((targ-min_data),(max_data-min_data+eps))
+    return norm_pred, norm_targ
+
+def ref_anomaly_results(pred_anom, targ_anom):
+    found = [False] * len(targ_anom)
+    fps = []
+
+    for anom in pred_anom:
+        match = False
+
+        for i in range(len(targ_anom)):
+            start, end = targ_anom[i]
+
+            if start <= anom <= end:
+                found[i] = True
+                match = True
+                break
+
+        if not match:
+            fps.append(anom)
+
+    return sum(found), len(found) - sum(found), len(fps)
+
+
+@pytest.fixture(params=["compiled", "numpy"])
+def kernel_backend(request, monkeypatch):
+    if request.param == "numpy":
+        monkeypatch.setattr(kernels, "HAS_NUMBA", False)
+        monkeypatch.setattr(kernels, "_aot", None)
+    return request.param
+
+@pytest.fixture(params=["scipy", "bottleneck"])
+def moving_average_backend(request, monkeypatch):
+    if request.param == "scipy":
+        monkeypatch.setattr(anomalies, "bn", None)
+    elif anomalies.bn is None:
+        pytest.skip("bottleneck is not installed")
+    return request.param
+
+
+@pytest.mark.parametrize("window", [1, 2, 3, 4, 7, 10])
+def test_moving_average(moving_average_backend, window):
+    x = np.random.RandomState(0).randn(50, 3)
+    np.testing.assert_allclose(anomalies.moving_average(x, window), ref_moving_average(x, window), atol=1E-12)
+
+def test_moving_average_1d(moving_average_backend):
+    x = np.random.RandomState(1).randn(20)
+    np.testing.assert_allclose(anomalies.moving_average(x, 4), ref_moving_average(x[:,None], 4)[:,0], atol=1E-12)
+
+def test_moving_average_empty(moving_average_backend):
+    assert anomalies.moving_average(np.zeros((0, 3)), 5).shape == (0, 3)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("order", ["C", "F"])
+def test_minmax_norm(kernel_backend, dtype, order):
+    data = np.asarray(np.random.RandomState(2).randn(40, 5), dtype=dtype, order=order)
+    norm = kernels.minmax_norm(data)
+
+    assert norm.shape == data.shape
+    np.testing.assert_allclose(norm, ref_minmax_norm(data), rtol=1E-5, atol=1E-6)
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_minmax_norm_pair(kernel_backend, dtype):
+    rng = np.random.RandomState(3)
+    targ = np.asfortranarray(rng.randn(40, 4), dtype=dtype)
+    pred = np.asfortranarray(rng.randn(30, 4), dtype=dtype)
+    norm_pred, norm_targ = kernels.minmax_norm_pair(pred, targ)
+    ref_pred, ref_targ = ref_minmax_norm_pair(pred, targ)
+
+    np.testing.assert_allclose(norm_pred, ref_pred, rtol=1E-5, atol=1E-6)
+    np.testing.assert_allclose(norm_targ, ref_targ, rtol=1E-5, atol=1E-6)
+
+def test_minmax_norm_readonly(kernel_backend):
+    data = np.random.RandomState(4).randn(10, 2)
+    data.setflags(write=False)
+    np.testing.assert_allclose(kernels.minmax_norm(data), ref_minmax_norm(data))
+
+def test_minmax_norm_empty(kernel_backend):
+    with pytest.raises(ValueError):
+        kernels.minmax_norm(np.zeros((0, 3)))
+
+def test_minmax_norm_pair_shape_mismatch(kernel_backend):
+    with pytest.raises(ValueError):
+        kernels.minmax_norm_pair(np.zeros((4, 2)), np.zeros((4, 3)))
+
+
+@pytest.mark.parametrize("pred_anom, targ_anom", [
+    ([], [(0, 10)]),
+    ([3, 5], []),
+    ([], []),
+    ([0, 10, 11, 25, 30, 31, 100], [(0, 10), (20, 30), (50, 60)]),
+    # unsorted and single point intervals
+    ([7, 7, 2, 42], [(40, 45), (7, 7), (1, 3)]),
+])
+def test_anomaly_results(kernel_backend, pred_anom, targ_anom):
+    params = AnomalyParameters()
+    assert tuple(params.get_anomaly_results(pred_anom, targ_anom)) == ref_anomaly_results(pred_anom, targ_anom)
+
+def test_anomaly_results_random(kernel_backend):
+    rng = np.random.RandomState(5)
+    starts = np.sort(rng.choice(1000, 30, replace=False)) * 10
+    targ_anom = [(s, s + rng.randint(0, 10)) for s in starts]
+    pred_anom = rng.randint(0, 10000, 200)
+
+    assert tuple(AnomalyParameters().get_anomaly_results(pred_anom, targ_anom)) == ref_anomaly_results(pred_anom, targ_anom)
+
+
+class DumpedModel:
+    """Model that only has dumped predictions"""
+    def __init__(self, sname):
+        self.sname = sname
+        self.shift = 0
+        self.logger_params = None
+
+
+def counting_loader(calls):
+    def loader(path):
+        calls.append(path)
+        return np.loadtxt(path, ndmin=1)
+    return loader
+
+def test_load_cached(tmp_path):
+    path = str(tmp_path / "data.txt")
+    prefix = str(tmp_path / "cache" / "data.txt.key")
+    np.savetxt(path, np.arange(5.))
+    calls = []
+
+    data = load_cached(path, counting_loader(calls), prefix)
+    cached = load_cached(path, counting_loader(calls), prefix)
+
+    assert len(calls) == 1
+    assert isinstance(cached, np.memmap) and not cached.flags.writeable
+    np.testing.assert_array_equal(cached, data)
+
+def test_load_cached_invalidation(tmp_path):
+    path = str(tmp_path / "data.txt")
+    prefix = str(tmp_path / "cache" / "data.txt.key")
+    np.savetxt(path, np.arange(5.))
+    calls = []
+    load_cached(path, counting_loader(calls), prefix)
+    stat = os.stat(path)
+
+    # same modification time, only the size tells the versions apart
+    np.savetxt(path, np.arange(8.))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    data = load_cached(path, counting_loader(calls), prefix)
+
+    assert len(calls) == 2
+    np.testing.assert_array_equal(data, np.arange(8.))
+    # only the cache of the current version is kept
+    assert len(os.listdir(str(tmp_path / "cache"))) == 1
+    np.testing.assert_array_equal(load_cached(path, counting_loader(calls), prefix), np.arange(8.))
+    assert len(calls) == 2
+
+def test_load_preds_errors_cached(tmp_path):
+    model = DumpedModel("model")
+    labels = ["a", "b"]
+    rng = np.random.RandomState(6)
+    pred, error = rng.randn(20, 2), rng.randn(20, 2)
+    os.makedirs(str(tmp_path / "model"))
+    dump_data(pred, labels, str(tmp_path / "model" / "data_pred.csv"))
+    dump_data(error, labels, str(tmp_path / "model" / "data_error.csv"))
+
+    def load():
+        plot = TimeseriesPlot(models=[model], datafiles=["data.csv"], output_dir=str(tmp_path),
+                              target_cols=labels, logger_params=LoggerParameters(display_progress=False),
+                              dump_format="csv", dtype=np.float64)
+        plot.load_preds_errors()
+        return plot.preds["data.csv"]["model"], plot.errors["data.csv"]["model"]
+
+    parsed = load()
+    cached = load()
+
+    for loaded, ref in zip(parsed, (pred, error)):
+        np.testing.assert_allclose(loaded, ref)
+    for loaded, ref in zip(cached, (pred, error)):
+        assert isinstance(loaded, np.memmap) and not loaded.flags.writeable
+        np.testing.assert_allclose(loaded, ref)
+
+
+def test_compute_anomalies_display_cached(monkeypatch, capsys):
+    plotted = []
+    monkeypatch.setattr(anomalies, "display_error_distribution", lambda *args: plotted.append(args))
+    params = AnomalyParameters(method="threshold_norm", smooth_factor=2)
+    params.labels = ["a", "b"]
+    error = np.random.RandomState(7).randn(200, 2)
+
+    results = params.compute_anomalies(error, display=True)
+    first = capsys.readouterr().out
+    # cache hit: same results, details are displayed again
+    assert params.compute_anomalies(error, display=True) is results
+    assert capsys.readouterr().out == first
+    assert "Selected" in first
+    assert len(plotted) == 4
+
+
+def layouts(data, path):
+    """data as C, fortran, read-only memory map and int arrays"""
+    np.save(str(path), data)
+    return {
+        "C": np.ascontiguousarray(data),
+        "F": np.asfortranarray(data),
+        "memmap": np.load(str(path), mmap_mode="r"),
+        "int": np.round(data * 10).astype(np.int64),
+    }
+
+@pytest.mark.skipif(not kernels.HAS_NUMBA, reason="numba is not installed")
+@pytest.mark.parametrize("layout", ["C", "F", "memmap", "int"])
+def test_kernels_after_warm_up(tmp_path, layout):
+    # compilation is disabled after warm up: every input must be converted
+    # to the compiled signatures
+    kernels.warm_up()
+    kernels.compile_parallel()
+    rng = np.random.RandomState(8)
+    data = layouts(rng.randn(30, 3), tmp_path / "data.npy")[layout]
+    ref = layouts(rng.randn(30, 3), tmp_path / "ref.npy")[layout]
+
+    np.testing.assert_allclose(kernels.minmax_norm(data), ref_minmax_norm(data), rtol=1E-5, atol=1E-6)
+
+    norm_data, norm_ref = kernels.minmax_norm_pair(data, ref)
+    ref_data, ref_ref = ref_minmax_norm_pair(data, ref)
+    np.testing.assert_allclose(norm_data, ref_data, rtol=1E-5, atol=1E-6)
+    np.testing.assert_allclose(norm_ref, ref_ref, rtol=1E-5, atol=1E-6)
+
+    min_ref, inv_range = kernels.minmax_bounds(ref)
+    np.testing.assert_allclose(kernels.minmax_apply(data, min_ref, inv_range), ref_data, rtol=1E-5, atol=1E-6)
+
+    for i in range(data.shape[1]):
+        pred, targ = data[:,i], ref[:,i]
+        np.testing.assert_allclose(kernels.mean_abs_error_norm(pred, targ),
+                                   np.mean(np.abs(ref_ref[:,i] - ref_data[:,i])), rtol=1E-5)
+
+    pred_anom = np.sort(np.abs(data[:,0]).astype(np.int64) * 7)
+    targ_anom = [(0, 2), (5, 9), (14, 14)]
+    starts, ends = np.array(targ_anom).T
+    assert tuple(kernels.anomaly_results(pred_anom, starts, ends)) == ref_anomaly_results(pred_anom, targ_anom)
+
+
+def random_preds(rng, models, shape, dtype=np.float32):
+    return {m: np.asfortranarray(rng.randn(*shape), dtype=dtype) for m in models}
+
+def test_stack_preds():
+    preds = random_preds(np.random.RandomState(9), ["m0", "m1", "m2"], (25, 4))
+    model_names, preds_arr = stack_preds(preds)
+
+    assert model_names == ["m0", "m1", "m2"]
+    assert preds_arr.shape == (3, 25, 4) and preds_arr.dtype == np.float32
+    for i, m in enumerate(model_names):
+        np.testing.assert_array_equal(preds_arr[i], preds[m])
+
+def test_stack_preds_empty():
+    model_names, preds_arr = stack_preds({})
+    assert model_names == [] and len(preds_arr) == 0
+    assert len(get_stacked_mean_error(preds_arr, np.zeros((5, 2)), 0)) == 0
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_stacked_mean_error(kernel_backend, dtype):
+    rng = np.random.RandomState(10)
+    preds = random_preds(rng, ["m0", "m1"], (30, 3), dtype)
+    targ = np.asfortranarray(rng.randn(30, 3), dtype=dtype)
+    model_names, preds_arr = stack_preds(preds)
+
+    for feat in range(3):
+        np.testing.assert_allclose(get_stacked_mean_error(preds_arr, targ, feat),
+                                   [get_signal_mean_error(preds[m], targ, feat) for m in model_names],
+                                   rtol=1E-4)
+
+def test_normalized_preds_array(kernel_backend, tmp_path):
+    rng = np.random.RandomState(11)
+    preds = random_preds(rng, ["m0", "m1"], (30, 3))
+    # shorter prediction, not stacked
+    preds["short"] = np.asfortranarray(rng.randn(20, 3), dtype=np.float32)
+    targ = np.asfortranarray(rng.randn(30, 3), dtype=np.float32)
+
+    plot = TimeseriesPlot(output_dir=str(tmp_path), target_cols=["a", "b", "c"],
+                          logger_params=LoggerParameters(display_progress=False), dump_format="csv")
+    plot.targs["data.csv"] = targ
+    plot.preds["data.csv"] = preds
+    model_names, preds_arr = plot.get_normalized_preds_array("data.csv")
+    targ_norm = plot.get_normalized_target("data.csv")
+
+    assert model_names == ["m0", "m1"]
+    for i, m in enumerate(model_names):
+        norm_pred, norm_targ = ref_minmax_norm_pair(preds[m], targ)
+        np.testing.assert_allclose(preds_arr[i], norm_pred, rtol=1E-4, atol=1E-5)
+        np.testing.assert_allclose(targ_norm, norm_targ, rtol=1E-4, atol=1E-5)
+        for feat in range(3):
+            np.testing.assert_allclose(np.mean(np.abs(preds_arr[i,:,feat] - targ_norm[:,feat])),
+                                       get_signal_mean_error(preds[m], targ, feat), rtol=1E-4)
+
+
+def dumped_plot(tmp_path, model, dump_format, **kwargs):
+    return TimeseriesPlot(models=[model], datafiles=["data.csv", "test/data.csv"], output_dir=str(tmp_path),
+                          target_cols=["a", "b"], logger_params=LoggerParameters(display_progress=False),
+                          dump_format=dump_format, dtype=np.float64, **kwargs)
+
+def dump_random_preds(plot, model):
+    rng = np.random.RandomState(12)
+    for datafile in plot.datafiles:
+        plot.preds[datafile] = {model.sname: rng.randn(15, 2)}
+        plot.errors[datafile] = {model.sname: rng.randn(15, 2)}
+    plot.dump_model_preds()
+    return plot.preds, plot.errors
+
+def assert_loaded(plot, model, preds, errors):
+    plot.load_preds_errors()
+    for datafile in plot.datafiles:
+        np.testing.assert_allclose(plot.preds[datafile][model.sname], preds[datafile][model.sname])
+        np.testing.assert_allclose(plot.errors[datafile][model.sname], errors[datafile][model.sname])
+
+@pytest.mark.parametrize("dump_format", ["parquet", "csv"])
+def test_dump_load_preds(tmp_path, dump_format):
+    if dump_format == "parquet":
+        pytest.importorskip("pyarrow")
+    model = DumpedModel("model")
+    preds, errors = dump_random_preds(dumped_plot(tmp_path, model, dump_format), model)
+
+    assert os.path.exists(str(tmp_path / "model" / "test" / ("data_pred." + dump_format)))
+    assert_loaded(dumped_plot(tmp_path, model, dump_format, use_file_cache=False), model, preds, errors)
+
+def test_load_preds_csv_fallback(tmp_path):
+    pytest.importorskip("pyarrow")
+    model = DumpedModel("model")
+    preds, errors = dump_random_preds(dumped_plot(tmp_path, model, "csv"), model)
+    plot = dumped_plot(tmp_path, model, "parquet", use_file_cache=False)
+
+    # csv dumps of previous versions are found when there is no parquet dump
+    assert plot.find_dump_filenames("data.csv", model) == plot.get_dump_filenames("data.csv", model, "csv")
+    assert plot.find_dump_filenames("missing.csv", model) is None
+    assert_loaded(plot, model, preds, errors)